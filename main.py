@@ -1,11 +1,16 @@
 import colorama
-from typing import Literal
+from collections import Counter
+from typing import Callable, Literal
+import bisect
+import heapq
 import math
 import random
+import sys
 
 
 # Types
 Tile = str
+TileId = int
 Coordinates = tuple[int, int]
 
 Up = tuple[Literal[1], Literal[0]]
@@ -16,26 +21,48 @@ Direction = Up | Down | Left | Right
 
 Compatibility = tuple[Tile, Tile, Direction]
 Weights = dict[Tile, int]
-Coefficients = set[Tile]
-CoefficientMatrix = list[list[Coefficients]]
+Coefficients = int
+CoefficientMatrix = list[Coefficients]
+SupportFunction = Callable[[Coefficients], Coefficients]
 
 UP = (1, 0)
 DOWN = (-1, 0)
 LEFT = (0, -1)
 RIGHT = (0, 1)
 DIRS = [UP, DOWN, LEFT, RIGHT]
+DIR_INDEX: dict[Direction, int] = {d: i for i, d in enumerate(DIRS)}
+# The valid directions for each 4-bit edge mask, whose bit `i` is set when a step in `DIRS[i]` stays inside the matrix.
+# `Model.propagate` computes a location's edge mask.
+EDGE_DIRS: list[tuple[Direction, ...]] = [tuple(d for i, d in enumerate(DIRS) if mask >> i & 1) for mask in range(16)]
+# Tile sets up to this size get a fully unrolled support function from `make_support_functions`.
+MAX_UNROLLED_TILES = 16
 
 
 """
 The CompatibilityOracle class is responsible for telling us which combinations of tiles and directions are compatible.
+Alongside the raw `data`, it precomputes `allowed[DIR_INDEX[d]][tile_id]`: a bitmask of the tile ids that can sit in
+direction `d` of the tile with id `tile_id`. Tile ids follow the order of `tiles`.
+`support_functions[DIR_INDEX[d]]` maps a bitmask of tiles to the union of their `allowed` bitmasks in direction `d`.
 """
 class CompatibilityOracle(object):
 
-    def __init__(self, data: set[Compatibility]):
+    def __init__(self, data: set[Compatibility], tiles: list[Tile]):
         self.data = data
+        self.tiles = list(tiles)
 
-    def check(self, tile1: Tile, tile2: Tile, direction: Direction) -> bool:
-        return (tile1, tile2, direction) in self.data
+        self.tile_to_id: dict[Tile, TileId] = {tile: tile_id for tile_id, tile in enumerate(tiles)}
+        self.allowed: list[list[int]] = [[0] * len(tiles) for _ in DIRS]
+        for tile1, tile2, direction in data:
+            self.allowed[DIR_INDEX[direction]][self.tile_to_id[tile1]] |= 1 << self.tile_to_id[tile2]
+
+        self.support_functions = make_support_functions(self.allowed)
+
+    """
+    Returns true if the tile with id `tile2` can sit in `direction` of the tile with id `tile1`. This is a lookup in
+    the precomputed `allowed` table rather than a hash of a (tile1, tile2, direction) tuple.
+    """
+    def check(self, tile1: TileId, tile2: TileId, direction: Direction) -> bool:
+        return (self.allowed[DIR_INDEX[direction]][tile1] >> tile2) & 1 == 1
 
 
 """
@@ -46,80 +73,97 @@ class Wavefunction(object):
 
     """
     Initialize new Wavefunction object for a grid of `size`, where the different tiles have overall weights `weights`.
+    Each tile is assigned an integer id `0..N-1` by its position in `tiles`, and the possible tiles at each location
+    are stored as a bitmask of these ids.
     Arguments:
         size -- a 2-tuple of (width, height)
         weights -- a dict of tile -> weight of tile
+        tiles -- every tile in `weights`, in tile id order
     """
     @staticmethod
-    def mk(size: tuple[int, int], weights: Weights):
-        coefficient_matrix = Wavefunction.init_coefficient_matrix(size, list(weights.keys()))
+    def mk(size: tuple[int, int], weights: Weights, tiles: list[Tile]):
+        id_to_tile = list(tiles)
+        coefficient_matrix = Wavefunction.init_coefficient_matrix(size, len(id_to_tile))
 
-        return Wavefunction(coefficient_matrix, weights)
+        return Wavefunction(coefficient_matrix, size, weights, id_to_tile)
 
     """
-    Initialize a 2-D Wavefunction matrix of coefficients. The matrix has size `size`, and each element of the matrix
-    starts with all possible tiles. No tile is forbidden yet.
+    Initialize a flattened Wavefunction matrix of coefficients. The matrix has size `size`, and each element of the
+    matrix starts with all possible tiles. No tile is forbidden yet.
     Arguments:
         size: a 2-tuple of (width, height)
-        tiles: a set of all the possible tiles
+        num_tiles: the number of possible tiles
     Returns:
-        A 2-D matrix where each element is a set
+        A flat list of length width * height where each element is a bitmask of possible tile ids
     """
     @staticmethod
-    def init_coefficient_matrix(size: tuple[int, int], tiles: list[Tile]) -> CoefficientMatrix:
-        coefficient_matrix: CoefficientMatrix = []
-
-        for _ in range(size[1]):
-            row: list[Coefficients] = []
-
-            for _ in range(size[0]):
-                row.append(set(tiles))
-            coefficient_matrix.append(row)
+    def init_coefficient_matrix(size: tuple[int, int], num_tiles: int) -> CoefficientMatrix:
+        width, height = size
 
-        return coefficient_matrix
+        return [(1 << num_tiles) - 1] * (width * height)
 
-    def __init__(self, coefficient_matrix: CoefficientMatrix, weights: Weights):
+    def __init__(self, coefficient_matrix: CoefficientMatrix, size: tuple[int, int], weights: Weights,
+                 id_to_tile: list[Tile]):
         self.coefficient_matrix = coefficient_matrix
+        self.width, self.height = size
         self.weights = weights
 
+        self.id_to_tile: tuple[Tile, ...] = tuple(id_to_tile)
+        self.tile_weights = [weights[tile] for tile in id_to_tile]
+        self.tile_weight_log_weights = [weight * math.log(weight) for weight in self.tile_weights]
+        # Entropy only depends on the mask, and only a handful of distinct masks occur in a run.
+        self.entropy_cache: dict[Coefficients, float] = {}
+
+        # Number of locations with more than 1 remaining possible tile, kept up to date by every mutation.
+        self.uncollapsed_count = sum(1 for mask in coefficient_matrix if mask & (mask - 1) != 0)
+        # The tile id each location has collapsed to, or -1 while it still has more or less than 1 possible tile.
+        self.collapsed_ids: list[TileId] = [
+            mask.bit_length() - 1 if mask & (mask - 1) == 0 else -1 for mask in coefficient_matrix
+        ]
+
+        # Min-heap of (entropy_plus_noise, index) with lazy invalidation: an entry is only current if its entropy
+        # matches `heap_entropy[index]`, the value most recently pushed for that location.
+        self.entropy_heap: list[tuple[float, int]] = []
+        self.heap_entropy: list[float | None] = [None] * len(coefficient_matrix)
+        push_entropy = self.push_entropy
+        for index in range(len(coefficient_matrix)):
+            push_entropy(index)
+
     """
-    Fetch the set of possible tiles at `co_ords`.
+    Fetch the bitmask of possible tiles at `co_ords`.
     Arguments:
         co_ords: tuple representing 2-D co-ordinates in the format (y, x).
     Returns:
-        The set of possible tiles.
+        The bitmask of possible tile ids.
     """
     def get(self, co_ords: Coordinates) -> Coefficients:
         y, x = co_ords
 
-        return self.coefficient_matrix[y][x]
+        return self.coefficient_matrix[y * self.width + x]
 
     """
     Returns the only remaining possible tile at `co_ords`. If there is not exactly 1 remaining possible tile then
     this method raises an exception.
     """
     def get_collapsed(self, co_ords: Coordinates) -> Tile:
-        options = self.get(co_ords)
-        assert(len(options) == 1)
+        y, x = co_ords
+        tile_id = self.collapsed_ids[y * self.width + x]
+        assert(tile_id != -1)
 
-        return next(iter(options))
+        return self.id_to_tile[tile_id]
 
     """
     Returns a 2-D matrix of the only remaining possible tiles at each location in the Wavefunction. If any location
     does not have exactly 1 remaining possible tile then this method raises an exception.
     """
     def get_all_collapsed(self) -> list[list[Tile]]:
-        height = len(self.coefficient_matrix)
-        width = len(self.coefficient_matrix[0])
+        assert(-1 not in self.collapsed_ids)
 
+        id_to_tile = self.id_to_tile
         collapsed: list[list[Tile]] = []
-        for y in range(height):
-            row: list[Tile] = []
-
-            for x in range(width):
-                row.append(self.get_collapsed((y, x)))
-
-            collapsed.append(row)
+        for row_start in range(0, len(self.collapsed_ids), self.width):
+            row_ids = self.collapsed_ids[row_start:row_start + self.width]
+            collapsed.append([id_to_tile[tile_id] for tile_id in row_ids])
 
         return collapsed
 
@@ -127,27 +171,39 @@ class Wavefunction(object):
     Calculates the Shannon Entropy of the Wavefunction at `co_ords`.
     """
     def shannon_entropy(self, co_ords: Coordinates) -> float:
-        y, x = co_ords
+        return self.mask_entropy(self.get(co_ords))
+
+    """
+    Calculates the Shannon Entropy of a bitmask of possible tiles `mask`.
+    """
+    def mask_entropy(self, mask: Coefficients) -> float:
+        entropy = self.entropy_cache.get(mask)
+        if entropy is not None:
+            return entropy
+
+        tile_weights = self.tile_weights
+        tile_weight_log_weights = self.tile_weight_log_weights
 
         sum_of_weights = 0
-        sum_of_weight_log_weights = 0
-        for option in self.coefficient_matrix[y][x]:
-            weight = self.weights[option]
-            sum_of_weights += weight
-            sum_of_weight_log_weights += weight * math.log(weight)
+        sum_of_weight_log_weights = 0.0
+        remaining = mask
+        while remaining:
+            bit = remaining & -remaining
+            remaining ^= bit
+            tile_id = bit.bit_length() - 1
+            sum_of_weights += tile_weights[tile_id]
+            sum_of_weight_log_weights += tile_weight_log_weights[tile_id]
+
+        entropy = math.log(sum_of_weights) - (sum_of_weight_log_weights / sum_of_weights)
+        self.entropy_cache[mask] = entropy
 
-        return math.log(sum_of_weights) - (sum_of_weight_log_weights / sum_of_weights)
+        return entropy
 
     """
     Returns true if every element in the Wavefunction is fully collapsed, and false otherwise.
     """
     def is_fully_collapsed(self) -> bool:
-        for row in self.coefficient_matrix:
-            for sq in row:
-                if len(sq) > 1:
-                    return False
-
-        return True
+        return self.uncollapsed_count == 0
 
     """
     Collapses the Wavefunction at `co_ords` to a single, definite tile. The tile is chosen randomly from the remaining
@@ -156,40 +212,82 @@ class Wavefunction(object):
     """
     def collapse(self, co_ords: Coordinates) -> None:
         y, x = co_ords
-        options = self.coefficient_matrix[y][x]
-        filtered_tiles_with_weights = [(tile, weight) for tile, weight in self.weights.items() if tile in options]
-
-        total_weights = sum([weight for _, weight in filtered_tiles_with_weights])
-        rand_weight = random.random() * total_weights
-
-        chosen = filtered_tiles_with_weights[0][0]
-        for tile, weight in filtered_tiles_with_weights:
-            rand_weight -= weight
-            if rand_weight < 0:
-                chosen = tile
-                break
-
-        self.coefficient_matrix[y][x] = set([chosen])
+        index = y * self.width + x
+        options = self.coefficient_matrix[index]
+        tile_weights = self.tile_weights
+
+        tile_ids: list[TileId] = []
+        cumulative_weights: list[int] = []
+        total_weights = 0
+        remaining = options
+        while remaining:
+            bit = remaining & -remaining
+            remaining ^= bit
+            tile_id = bit.bit_length() - 1
+            total_weights += tile_weights[tile_id]
+            tile_ids.append(tile_id)
+            cumulative_weights.append(total_weights)
+
+        # Weighted choice: the first tile whose cumulative weight exceeds the random draw, found by a C-level bisect.
+        chosen = tile_ids[bisect.bisect(cumulative_weights, random.random() * total_weights)]
+
+        if options & (options - 1) != 0:
+            self.uncollapsed_count -= 1
+        self.coefficient_matrix[index] = 1 << chosen
+        self.collapsed_ids[index] = chosen
 
     """
-    Removes `forbidden_tile` from the list of possible tiles at `co_ords`.
+    Pushes the current entropy of the location at flat `index` onto the entropy heap, superseding any earlier entry
+    for that location. Locations with at most 1 remaining possible tile are not pushed.
     This method mutates the Wavefunction and does not return anything.
     """
-    def constrain(self, co_ords: Coordinates, forbidden_tile: Tile) -> None:
-        y, x = co_ords
-        self.coefficient_matrix[y][x].remove(forbidden_tile)
+    def push_entropy(self, index: int) -> None:
+        mask = self.coefficient_matrix[index]
+        if mask & (mask - 1) == 0:
+            return
+
+        # Add some noise to mix things up a little
+        entropy_plus_noise = self.mask_entropy(mask) - (random.random() / 1000)
+        self.heap_entropy[index] = entropy_plus_noise
+        heapq.heappush(self.entropy_heap, (entropy_plus_noise, index))
 
 
 class Model(object):
 
     """
     The Model class is responsible for orchestrating the Wavefunction Collapse algorithm.
+    Arguments:
+        output_size -- a 2-tuple of (width, height)
+        weights -- a dict of tile -> weight of tile
+        compatibility_oracle -- the CompatibilityOracle for the tiles in `weights`. The Wavefunction numbers tiles in
+            the oracle's tile order, so that both agree on tile ids.
+        propagation_radius -- if set, propagation stops spreading beyond this Chebyshev distance from the collapsed
+            location. This is faster on large outputs but far-away constraints are no longer enforced, so the run is
+            more likely to hit a contradiction. It is only suitable for examples whose constraints are local; on
+            examples with long-range structure, such as the bundled land/coast/sea example, even a radius of 30 hits
+            contradictions on a 60x60 output. Must be at least 1. Defaults to None, which propagates without limit.
     """
-    def __init__(self, output_size: tuple[int, int], weights: Weights, compatibility_oracle: CompatibilityOracle):
+    def __init__(self, output_size: tuple[int, int], weights: Weights, compatibility_oracle: CompatibilityOracle,
+                 propagation_radius: int | None = None):
+        if propagation_radius is not None and propagation_radius < 1:
+            raise ValueError("`propagation_radius` must be at least 1")
+
         self.output_size = output_size
         self.compatibility_oracle = compatibility_oracle
+        self.propagation_radius = propagation_radius
+
+        if set(weights) != set(compatibility_oracle.tiles):
+            raise ValueError("the tiles in `weights` must be the same as the compatibility oracle's tiles")
 
-        self.wavefunction = Wavefunction.mk(output_size, weights)
+        self.wavefunction = Wavefunction.mk(output_size, weights, compatibility_oracle.tiles)
+
+        # For each 4-bit edge mask (see `EDGE_DIRS`), the (direction index, flat index offset) of every valid
+        # direction. `propagate` finds a location's neighbours from its edge mask, so construction does not depend on
+        # the size of the output.
+        width = output_size[0]
+        self.neighbor_offsets: list[tuple[tuple[int, int], ...]] = [
+            tuple((DIR_INDEX[d], d[0] * width + d[1]) for d in dirs) for dirs in EDGE_DIRS
+        ]
 
     """
     Collapses the Wavefunction until it is fully collapsed, then returns a 2-D matrix of the final, collapsed state.
@@ -214,60 +312,83 @@ class Model(object):
     """
     Propagates the consequences of the Wavefunction at `co_ords` collapsing. If the wavefunction at (y, x) collapses
     to a fixed tile, then some tiles may no longer be theoretically possible at surrounding locations.
-    This method keeps propagating the consequences of the consequences, and so on until no consequences remain.
+    This method keeps propagating the consequences of the consequences, and so on until no consequences remain, or
+    until they are further than `propagation_radius` from `co_ords`.
     """
     def propagate(self, co_ords: Coordinates) -> None:
-        stack = [co_ords]
+        origin_y, origin_x = co_ords
+        radius = self.propagation_radius
 
-        while len(stack) > 0:
-            cur_co_ords = stack.pop()
+        # Work on the flat matrix directly rather than through Wavefunction.get/set in this hot loop.
+        coefficient_matrix = self.wavefunction.coefficient_matrix
+        width = self.wavefunction.width
+        height = self.wavefunction.height
+        support_functions = self.compatibility_oracle.support_functions
+        neighbor_offsets = self.neighbor_offsets
+        collapsed_ids = self.wavefunction.collapsed_ids
+        push_entropy = self.wavefunction.push_entropy
 
-            # Get the set of all possible tiles at the current location
-            cur_possible_tiles = self.wavefunction.get(cur_co_ords)
+        # The stack holds flat indices rather than (y, x) tuples.
+        stack = [origin_y * width + origin_x]
 
-            # Iterate through each location immediately adjacent to the current location.
-            for d in valid_dirs(cur_co_ords, self.output_size):
-                other_co_ords = (cur_co_ords[0] + d[0], cur_co_ords[1] + d[1])
-
-                # Iterate through each possible tile in the adjacent location's Wavefunction.
-                for other_tile in set(self.wavefunction.get(other_co_ords)):
+        while len(stack) > 0:
+            cur_index = stack.pop()
 
-                    # Check whether the tile is compatible with any tile in the current location's Wavefunction.
-                    other_tile_is_possible = any([
-                        self.compatibility_oracle.check(cur_tile, other_tile, d) for cur_tile in cur_possible_tiles
-                    ])
+            # Get the bitmask of all possible tiles at the current location
+            cur_possible_tiles = coefficient_matrix[cur_index]
 
-                    """
-                    If the tile is not compatible with any of the tiles in the current location's Wavefunction then it
-                    is impossible for it to ever get chosen. We therefore remove it from the other location's 
-                    Wavefunction.
-                    """
-                    if not other_tile_is_possible:
-                        self.wavefunction.constrain(other_co_ords, other_tile)
-                        stack.append(other_co_ords)
+            # Iterate through each location immediately adjacent to the current location.
+            cur_y, cur_x = divmod(cur_index, width)
+            edge_mask = (cur_y < height-1) | (cur_y > 0) << 1 | (cur_x > 0) << 2 | (cur_x < width-1) << 3
+            for d_index, offset in neighbor_offsets[edge_mask]:
+                other_index = cur_index + offset
+
+                # Get the bitmask of tiles compatible with any tile in the current location's Wavefunction.
+                support = support_functions[d_index](cur_possible_tiles)
+
+                """
+                Any tile that is not compatible with any of the tiles in the current location's Wavefunction is
+                impossible to ever get chosen. We therefore remove all of them from the other location's Wavefunction
+                in one go.
+                """
+                other_mask = coefficient_matrix[other_index]
+                new_other_mask = other_mask & support
+                if new_other_mask != other_mask:
+                    # Besides Wavefunction.collapse, this is the only place a mask changes, so it also keeps the
+                    # Wavefunction's uncollapsed_count, collapsed_ids and entropy heap up to date.
+                    coefficient_matrix[other_index] = new_other_mask
+                    if new_other_mask & (new_other_mask - 1) != 0:
+                        push_entropy(other_index)
+                    else:
+                        collapsed_ids[other_index] = new_other_mask.bit_length() - 1
+                        if other_mask & (other_mask - 1) != 0:
+                            self.wavefunction.uncollapsed_count -= 1
+
+                    if radius is not None:
+                        other_y, other_x = divmod(other_index, width)
+                        if max(abs(other_y - origin_y), abs(other_x - origin_x)) > radius:
+                            continue
+                    stack.append(other_index)
 
     """
-    Returns the co-ords of the location whose Wavefunction has the lowest entropy.
+    Returns the co-ords of the location whose Wavefunction has the lowest entropy. Stale entries at the top of the
+    Wavefunction's entropy heap are discarded along the way.
     """
     def min_entropy_co_ords(self) -> Coordinates:
-        min_entropy = None
-        min_entropy_co_ords: Coordinates = (0, 0)
-
-        width, height = self.output_size
-        for y in range(height):
-            for x in range(width):
-                if len(self.wavefunction.get((y, x))) == 1:
-                    continue
+        coefficient_matrix = self.wavefunction.coefficient_matrix
+        entropy_heap = self.wavefunction.entropy_heap
+        heap_entropy = self.wavefunction.heap_entropy
+        heappop = heapq.heappop
 
-                entropy = self.wavefunction.shannon_entropy((y, x))
+        while len(entropy_heap) > 0:
+            entropy_plus_noise, index = entropy_heap[0]
+            mask = coefficient_matrix[index]
+            if heap_entropy[index] == entropy_plus_noise and mask & (mask - 1) != 0:
+                return divmod(index, self.wavefunction.width)
 
-                # Add some noise to mix things up a little
-                entropy_plus_noise = entropy - (random.random() / 1000)
-                if min_entropy is None or entropy_plus_noise < min_entropy:
-                    min_entropy = entropy_plus_noise
-                    min_entropy_co_ords = (y, x)
+            heappop(entropy_heap)
 
-        return min_entropy_co_ords
+        return (0, 0)
 
 
 """
@@ -277,30 +398,48 @@ Arguments:
     colors -- dict of tile -> `colorama` color
 """
 def render_colors(matrix: list[list[Tile]], colors: dict[str, str]) -> None:
-    for row in matrix:
-        output_row: list[str] = []
-        
-        for val in row:
-            color = colors[val]
-            output_row.append(color + val + colorama.Style.RESET_ALL)
+    rendered_tiles = {tile: color + tile + colorama.Style.RESET_ALL for tile, color in colors.items()}
+    output_rows = ["".join([rendered_tiles[val] for val in row]) for row in matrix]
 
-        print("".join(output_row))
+    sys.stdout.write("\n".join(output_rows) + "\n")
 
 """
-Returns the valid directions from `cur_co_ord` in a matrix of `matrix_size`. 
-Ensures that we don't try to take step to the left when we are already on the left edge of the matrix.
+Generates a support function per direction, specialised to the `allowed` table of a CompatibilityOracle. Each function
+takes a bitmask of tiles and returns the union of their `allowed` bitmasks in that direction. The allowed bitmasks are
+emitted into the generated source as literal constants. For up to `MAX_UNROLLED_TILES` tiles the loop over the bits of
+the mask is unrolled into one conditional term per tile, and tiles that allow nothing are left out entirely.
+Arguments:
+    allowed -- a list, indexed by direction index, of lists of allowed bitmasks indexed by tile id
+Returns:
+    A list of support functions indexed by direction index
 """
-def valid_dirs(cur_co_ords: Coordinates, matrix_size: tuple[int, int]) -> list[Direction]:
-    y, x = cur_co_ords
-    width, height = matrix_size
-    dirs: list[Direction] = []
-
-    if y < height-1: dirs.append(UP)
-    if y > 0: dirs.append(DOWN)
-    if x > 0: dirs.append(LEFT)
-    if x < width-1: dirs.append(RIGHT)
-
-    return dirs
+def make_support_functions(allowed: list[list[int]]) -> list[SupportFunction]:
+    source_lines: list[str] = []
+
+    for d_index, allowed_in_dir in enumerate(allowed):
+        source_lines.append(f"def support_{d_index}(mask):")
+
+        if len(allowed_in_dir) <= MAX_UNROLLED_TILES:
+            terms = [
+                f"({allowed_mask} if mask & {1 << tile_id} else 0)"
+                for tile_id, allowed_mask in enumerate(allowed_in_dir) if allowed_mask != 0
+            ]
+            source_lines.append(f"    return {' | '.join(terms) or '0'}")
+        else:
+            source_lines += [
+                f"    allowed_in_dir = {tuple(allowed_in_dir)!r}",
+                "    support = 0",
+                "    while mask:",
+                "        bit = mask & -mask",
+                "        mask ^= bit",
+                "        support |= allowed_in_dir[bit.bit_length() - 1]",
+                "    return support",
+            ]
+
+    namespace: dict[str, SupportFunction] = {}
+    exec(compile("\n".join(source_lines), "<support_functions>", "exec"), namespace)
+
+    return [namespace[f"support_{d_index}"] for d_index in range(len(allowed))]
 
 """
 Parses an example `matrix`. 
@@ -315,22 +454,25 @@ Returns:
         * a dict of weights of the form tile -> weight
 """
 def parse_example_matrix(matrix: list[list[Tile]]) -> tuple[set[Compatibility], Weights]:
-    compatibilities: set[Compatibility] = set()
-    matrix_height = len(matrix)
-    matrix_width = len(matrix[0])
+    weights: Weights = dict(Counter(tile for row in matrix for tile in row))
 
-    weights: Weights = {}
+    # Collect each distinct pair of horizontally and vertically adjacent tiles once, then expand every pair into the
+    # compatibility in both directions.
+    horizontal_pairs: set[tuple[Tile, Tile]] = set()
+    for row in matrix:
+        horizontal_pairs.update(zip(row, row[1:]))
 
-    for y, row in enumerate(matrix):
-        for x, cur_tile in enumerate(row):
-            if cur_tile not in weights:
-                weights[cur_tile] = 0
-    
-            weights[cur_tile] += 1
+    vertical_pairs: set[tuple[Tile, Tile]] = set()
+    for row, next_row in zip(matrix, matrix[1:]):
+        vertical_pairs.update(zip(row, next_row))
 
-            for d in valid_dirs((y, x), (matrix_width, matrix_height)):
-                other_tile = matrix[y+d[0]][x+d[1]]
-                compatibilities.add((cur_tile, other_tile, d))
+    compatibilities: set[Compatibility] = set()
+    for tile, right_tile in horizontal_pairs:
+        compatibilities.add((tile, right_tile, RIGHT))
+        compatibilities.add((right_tile, tile, LEFT))
+    for tile, up_tile in vertical_pairs:
+        compatibilities.add((tile, up_tile, UP))
+        compatibilities.add((up_tile, tile, DOWN))
 
     return compatibilities, weights
 
@@ -352,7 +494,7 @@ input_matrix2 = [['A','A','A','A'],
                  ['B','B','B','B']]
 
 compatibilities, weights = parse_example_matrix(input_matrix)
-compatibility_oracle = CompatibilityOracle(compatibilities)
+compatibility_oracle = CompatibilityOracle(compatibilities, list(weights.keys()))
 model = Model((100, 10), weights, compatibility_oracle)
 output = model.run()
 